@@ -1,12 +1,18 @@
+import asyncio
 import os
 import logging
 import re
 import time
+import weakref
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
 from slack_sdk.errors import SlackApiError
-from openai import OpenAI, OpenAIError
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAIError
+import redis.asyncio
 
 # --- Configuration ---
 logging.basicConfig(level=logging.INFO)
@@ -14,15 +20,41 @@ logger = logging.getLogger(__name__)
 load_dotenv() # Load environment variables from .env file
 
 # --- Constants ---
-POLLING_INTERVAL_S = 2 # How often to check Run status (seconds)
+STREAM_UPDATE_INTERVAL_S = 1 # Min time between partial-response updates in Slack
 RUN_TIMEOUT_S = 120 # Max time to wait for a Run to complete
+ACTIVE_RUN_STATUSES = frozenset({"queued", "in_progress", "requires_action"}) # Run statuses that still block the thread
+MAX_CONCURRENT_RUNS = 8 # Max Assistant runs in flight at once
+OPENAI_MAX_CONNECTIONS = 128 # Max open connections to the OpenAI API
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 64 # Max idle connections kept open for reuse
+OPENAI_TIMEOUT_S = 30 # Per-request OpenAI read/write timeout (run streams use RUN_TIMEOUT_S instead)
+OPENAI_CONNECT_TIMEOUT_S = 5 # OpenAI connection timeout
+SLACK_WRITE_INTERVAL_S = 1 # Min time between Slack writes of the same method to the same channel
+SLACK_RATE_LIMIT_RETRIES = 3 # How many times to retry a Slack call that was rate limited (HTTP 429)
+MAX_PENDING_TASKS = 64 # Max conversations running or waiting for a run slot
+THREAD_MAP_TTL_S = 7 * 86400 # How long a Slack thread -> OpenAI thread mapping is kept in Redis
+THREAD_MAP_CACHE_SIZE = 10000 # Max Slack thread -> OpenAI thread mappings cached in memory
+THREAD_MAP_CACHE_TTL_S = 86400 # How long a mapping stays in the in-memory cache
+THREAD_MAP_KEY_PREFIX = "st:" # Redis key prefix for Slack thread -> OpenAI thread mappings
+SEEN_EVENT_KEY_PREFIX = "seen:" # Redis key prefix marking Slack events that were already handled
+SEEN_EVENT_TTL_S = 600 # How long handled Slack events are remembered for deduplication
+SUPPORTED_CHANNEL_TYPES = frozenset({"channel", "group", "im", "mpim"}) # Channel types the bot replies in
 
 # --- Initialize Slack App ---
-app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
+app = AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
+# Retry rate-limited Slack calls after the delay given in the Retry-After header
+app.client.retry_handlers.append(AsyncRateLimitErrorRetryHandler(max_retry_count=SLACK_RATE_LIMIT_RETRIES))
 
 # --- Initialize OpenAI Client ---
 try:
-    openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    # Reuse keep-alive HTTP/2 connections so runs don't pay a TLS handshake per API call
+    openai_client = AsyncOpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT_S, connect=OPENAI_CONNECT_TIMEOUT_S),
+        ),
+    )
     if not os.environ.get("OPENAI_API_KEY"):
         logging.error("OPENAI_API_KEY not found in environment variables.")
         openai_client = None
@@ -31,175 +63,367 @@ try:
          logging.error("OPENAI_ASSISTANT_ID not found in environment variables.")
          openai_client = None # Effectively disable if no assistant ID
 except Exception as e:
-    logging.error(f"Error initializing OpenAI client or getting Assistant ID: {e}")
+    logging.error("Error initializing OpenAI client or getting Assistant ID: %s", e)
     openai_client = None
     OPENAI_ASSISTANT_ID = None
 
-# --- State Management (In-Memory - NOT PRODUCTION READY) ---
+# --- Initialize Redis Client ---
+try:
+    redis_client = redis.asyncio.Redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+except KeyError:
+    logging.warning("REDIS_URL not found in environment variables. Thread mappings will not survive restarts.")
+    redis_client = None
+except Exception as e:
+    logging.error("Error initializing Redis client: %s", e)
+    redis_client = None
+
+# --- State Management ---
 # Stores mapping: Slack thread_ts -> OpenAI thread_id
-# WARNING: This dictionary is lost if the bot restarts. Use a database for production.
-slack_thread_to_openai_thread = {}
+# Redis is the source of truth; this is a bounded local front-line cache for hot threads.
+slack_thread_to_openai_thread = TTLCache(maxsize=THREAD_MAP_CACHE_SIZE, ttl=THREAD_MAP_CACHE_TTL_S)
+
+# --- Slack Write Throttling ---
+# Stores mapping: (Slack API method, channel_id) -> monotonic time the next write may be sent
+slack_write_schedule = {}
+
+# --- Background Processing ---
+# Assistant runs can take up to RUN_TIMEOUT_S, so they run as background tasks
+# instead of holding up the Socket Mode event handlers.
+run_slots = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
+pending_task_count = 0
+background_tasks = set() # Keeps references so running tasks aren't garbage collected
+# OpenAI threads reject concurrent runs, so messages in the same Slack thread are serialized.
+# Entries disappear once no task holds or waits on the lock.
+slack_thread_locks = weakref.WeakValueDictionary()
 
 # --- Helper Functions ---
-def get_bot_user_id(client):
-    """Fetches the bot's user ID."""
-    try:
-        response = client.auth_test()
-        return response["user_id"]
-    except SlackApiError as e:
-        logging.error(f"Error fetching bot user ID: {e}")
-        return None
-
-BOT_USER_ID = get_bot_user_id(app.client)
+# Taken from Bolt's authorization result (its own cached auth.test) on the first event
+BOT_USER_ID = None
+BOT_MENTION_PREFIX = None
+MENTION_RE = None
+
+def remember_bot_user_id(bot_user_id):
+    """Records the bot's user ID from Bolt's context and precompiles the mention pattern."""
+    global BOT_USER_ID, BOT_MENTION_PREFIX, MENTION_RE
+    if not bot_user_id or bot_user_id == BOT_USER_ID:
+        return
+    BOT_USER_ID = bot_user_id
+    BOT_MENTION_PREFIX = f"<@{BOT_USER_ID}>"
+    MENTION_RE = re.compile(rf"^\s*<@{BOT_USER_ID}>\s*")
+    logger.info("Bot User ID: %s", BOT_USER_ID)
 
-def clean_mention(text, bot_user_id):
+def clean_mention(text):
     """Removes the bot mention from the start of a message."""
-    if bot_user_id:
-        mention = f"<@{bot_user_id}>"
-        pattern = rf"^\s*<@{bot_user_id}>\s*"
-        return re.sub(pattern, '', text).strip()
+    if MENTION_RE:
+        return MENTION_RE.sub('', text).strip()
     return text.strip()
 
+async def wait_for_slack_write_slot(method, channel_id):
+    """Waits until a write of the given Slack API method to the channel is allowed.
+
+    Each (method, channel) pair gets one token every SLACK_WRITE_INTERVAL_S, keeping
+    bursts from concurrent conversations under Slack's per-method rate limits.
+    """
+    key = (method, channel_id)
+    now = time.monotonic()
+    if key not in slack_write_schedule:
+        # Drop slots that have already passed so the schedule only holds recently active channels
+        for stale_key in [k for k, t in slack_write_schedule.items() if t <= now]:
+            del slack_write_schedule[stale_key]
+    send_at = max(now, slack_write_schedule.get(key, now))
+    slack_write_schedule[key] = send_at + SLACK_WRITE_INTERVAL_S
+    if send_at > now:
+        await asyncio.sleep(send_at - now)
+
+async def rate_limited_chat_update(channel_id, ts, text):
+    """Edits a Slack message once the channel's chat.update rate limit allows it."""
+    await wait_for_slack_write_slot("chat.update", channel_id)
+    return await app.client.chat_update(channel=channel_id, ts=ts, text=text)
+
+async def rate_limited_say(say, channel_id, text, thread_ts):
+    """Posts a Slack message once the channel's chat.postMessage rate limit allows it."""
+    await wait_for_slack_write_slot("chat.postMessage", channel_id)
+    return await say(text=text, thread_ts=thread_ts)
+
+async def set_openai_thread_id(slack_thread_ts, openai_thread_id):
+    """Maps a Slack thread to an OpenAI thread locally and in Redis."""
+    slack_thread_to_openai_thread[slack_thread_ts] = openai_thread_id
+    if not redis_client:
+        return
+    try:
+        await redis_client.set(f"{THREAD_MAP_KEY_PREFIX}{slack_thread_ts}", openai_thread_id, ex=THREAD_MAP_TTL_S)
+    except redis.RedisError as e:
+        logging.error("Error writing thread mapping to Redis: %s", e)
+
+async def claim_event(dedupe_id, slack_thread_ts):
+    """Marks a Slack event as seen and looks up its OpenAI thread in one Redis round-trip.
+
+    Returns (is_duplicate, openai_thread_id), where is_duplicate is True for a redelivery
+    and openai_thread_id is None if the Slack thread isn't mapped yet.
+    """
+    openai_thread_id = slack_thread_to_openai_thread.get(slack_thread_ts)
+    if not redis_client:
+        return False, openai_thread_id
+    thread_map_key = f"{THREAD_MAP_KEY_PREFIX}{slack_thread_ts}"
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            if dedupe_id:
+                pipe.set(f"{SEEN_EVENT_KEY_PREFIX}{dedupe_id}", "1", nx=True, ex=SEEN_EVENT_TTL_S)
+            # Refresh the mapping's TTL on every message so only idle conversations expire.
+            # A local cache hit still sends EXPIRE; it only saves fetching the value.
+            if openai_thread_id:
+                pipe.expire(thread_map_key, THREAD_MAP_TTL_S)
+            else:
+                pipe.getex(thread_map_key, ex=THREAD_MAP_TTL_S)
+            results = await pipe.execute()
+    except redis.RedisError as e:
+        logging.error("Error checking event deduplication in Redis: %s", e)
+        return False, openai_thread_id # Prefer a possible duplicate reply over dropping the message
+
+    is_duplicate = bool(dedupe_id) and not results[0]
+    if not openai_thread_id and results[-1]:
+        openai_thread_id = results[-1]
+        slack_thread_to_openai_thread[slack_thread_ts] = openai_thread_id
+    return is_duplicate, openai_thread_id
+
+async def cancel_run_if_active(openai_thread_id, run):
+    """Cancels an abandoned run so it doesn't block new messages on its OpenAI thread."""
+    if not run or run.status not in ACTIVE_RUN_STATUSES:
+        return
+    try:
+        await openai_client.beta.threads.runs.cancel(thread_id=openai_thread_id, run_id=run.id)
+        logging.info("Cancelled run %s on thread %s", run.id, openai_thread_id)
+    except OpenAIError as e:
+        logging.error("Error cancelling run %s: %s", run.id, e)
+
 # --- Core Assistant Processing Logic ---
-def process_with_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger):
-    """Handles the interaction with the OpenAI Assistant for a given prompt and thread."""
+async def process_with_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger, openai_thread_id=None):
+    """Handles the interaction with the OpenAI Assistant for a given prompt and thread.
+
+    openai_thread_id is the mapping the event handler already looked up, if any.
+    """
     if not openai_client or not OPENAI_ASSISTANT_ID:
         logger.error("OpenAI client or Assistant ID not configured.")
         # Use say directly as we might not have initiated a thinking message
         try:
-            say("Sorry, the OpenAI connection or Assistant is not configured correctly. Please check server logs.", thread_ts=slack_thread_ts)
+            await rate_limited_say(say, channel_id, "Sorry, the OpenAI connection or Assistant is not configured correctly. Please check server logs.", slack_thread_ts)
         except SlackApiError as e:
-            logger.error(f"Slack error reporting config issue: {e}")
+            logger.error("Slack error reporting config issue: %s", e)
         return
 
     # --- Acknowledge receipt ---
     thinking_message_ts = None
     try:
         # Use say function passed from the event handler
-        thinking_reply = say(text="🤔 Thinking (using Assistant)...", thread_ts=slack_thread_ts)
+        thinking_reply = await rate_limited_say(say, channel_id, "🤔 Thinking (using Assistant)...", slack_thread_ts)
         thinking_message_ts = thinking_reply.get('ts') if thinking_reply and thinking_reply.get('ok') else None
     except SlackApiError as e:
-        logger.error(f"Error posting thinking message: {e}")
+        logger.error("Error posting thinking message: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error posting thinking message: {e}")
+        logger.error("Unexpected error posting thinking message: %s", e)
 
 
-    openai_thread_id = None
     run = None
 
     try:
         # --- 1. Find or Create OpenAI Thread ---
-        if slack_thread_ts in slack_thread_to_openai_thread:
-            openai_thread_id = slack_thread_to_openai_thread[slack_thread_ts]
-            logger.info(f"Found existing OpenAI thread ID: {openai_thread_id} for Slack thread: {slack_thread_ts}")
+        # Re-check the local cache in case an earlier message in this Slack thread
+        # created the OpenAI thread while this one was waiting for the thread lock.
+        openai_thread_id = openai_thread_id or slack_thread_to_openai_thread.get(slack_thread_ts)
+        if openai_thread_id:
+            logger.info("Found existing OpenAI thread ID: %s for Slack thread: %s", openai_thread_id, slack_thread_ts)
         else:
-            logger.info(f"Creating new OpenAI thread for Slack thread: {slack_thread_ts}")
-            thread = openai_client.beta.threads.create()
+            logger.info("Creating new OpenAI thread for Slack thread: %s", slack_thread_ts)
+            thread = await openai_client.beta.threads.create()
             openai_thread_id = thread.id
-            slack_thread_to_openai_thread[slack_thread_ts] = openai_thread_id # WARNING: Store persistently!
-            logger.info(f"Created OpenAI thread ID: {openai_thread_id} and mapped to Slack thread: {slack_thread_ts}")
+            await set_openai_thread_id(slack_thread_ts, openai_thread_id)
+            logger.info("Created OpenAI thread ID: %s and mapped to Slack thread: %s", openai_thread_id, slack_thread_ts)
 
         # --- 2. Add User Message to Thread ---
-        logger.info(f"Adding message to OpenAI thread {openai_thread_id}: '{prompt}'")
-        user_openai_message = openai_client.beta.threads.messages.create(
+        logger.info("Adding message to OpenAI thread %s: '%s'", openai_thread_id, prompt)
+        await openai_client.beta.threads.messages.create(
             thread_id=openai_thread_id,
             role="user",
             content=prompt,
         )
 
-        # --- 3. Run the Assistant ---
-        logger.info(f"Creating Assistant Run for thread {openai_thread_id} using Assistant {OPENAI_ASSISTANT_ID}")
-        run = openai_client.beta.threads.runs.create(
-            thread_id=openai_thread_id,
-            assistant_id=OPENAI_ASSISTANT_ID,
-        )
-        logger.info(f"Run created with ID: {run.id}, Status: {run.status}")
-
-        # --- 4. Poll for Run Completion ---
-        start_time = time.time()
-        while run.status in ["queued", "in_progress", "cancelling"]:
-            if time.time() - start_time > RUN_TIMEOUT_S:
-                logger.warning(f"Run {run.id} timed out after {RUN_TIMEOUT_S} seconds.")
-                openai_client.beta.threads.runs.cancel(thread_id=openai_thread_id, run_id=run.id)
-                raise TimeoutError("Assistant run timed out.")
-
-            time.sleep(POLLING_INTERVAL_S)
-            run = openai_client.beta.threads.runs.retrieve(thread_id=openai_thread_id, run_id=run.id)
-            logger.info(f"Checking Run {run.id} status: {run.status}")
+        # --- 3. Stream the Assistant Run ---
+        logger.info("Streaming Assistant Run for thread %s using Assistant %s", openai_thread_id, OPENAI_ASSISTANT_ID)
+        last_update_time = time.monotonic()
+        completed_texts = [] # Text of each finished assistant message
+        partial_text = "" # Text of the assistant message currently being streamed
+        has_pending_text = False # Whether text has arrived since the last Slack update
+
+        async def consume_run_stream():
+            nonlocal run, last_update_time, partial_text, has_pending_text
+            # Runs can go quiet for a while (e.g. before the first delta), so the stream's
+            # read timeout follows RUN_TIMEOUT_S rather than the client's CRUD timeout.
+            async with openai_client.beta.threads.runs.stream(
+                thread_id=openai_thread_id,
+                assistant_id=OPENAI_ASSISTANT_ID,
+                timeout=httpx.Timeout(RUN_TIMEOUT_S, connect=OPENAI_CONNECT_TIMEOUT_S),
+            ) as stream:
+                async for stream_event in stream:
+                    if stream_event.event.startswith("thread.run.") and not stream_event.event.startswith("thread.run.step."):
+                        run = stream_event.data
+                        logger.info("Run %s status: %s", run.id, run.status)
+                    elif stream_event.event == "thread.message.delta":
+                        for content_block in stream_event.data.delta.content or []:
+                            if content_block.type == 'text' and content_block.text and content_block.text.value:
+                                partial_text += content_block.text.value
+                                has_pending_text = True
+                    elif stream_event.event == "thread.message.completed":
+                        completed_texts.append("".join(
+                            content_block.text.value
+                            for content_block in stream_event.data.content
+                            if content_block.type == 'text'
+                        ))
+                        partial_text = ""
+
+                    # Coalesce deltas into at most one partial update per STREAM_UPDATE_INTERVAL_S;
+                    # the final response below always replaces whatever was shown last.
+                    if thinking_message_ts and has_pending_text and time.monotonic() - last_update_time >= STREAM_UPDATE_INTERVAL_S:
+                        last_update_time = time.monotonic()
+                        has_pending_text = False
+                        shown_texts = completed_texts + [partial_text] if partial_text else completed_texts
+                        # Best effort: a failed or slow partial update must not abort the run
+                        try:
+                            await rate_limited_chat_update(channel_id, thinking_message_ts, "\n".join(shown_texts))
+                        except Exception as e:
+                            logger.warning("Error posting partial response: %s", e)
+
+        # --- 4. Consume Run Events ---
+        # The deadline cancels the stream task and sets a flag, so it can be told apart
+        # from TimeoutErrors raised inside the stream (which are handled as failures).
+        stream_task = asyncio.ensure_future(consume_run_stream())
+        run_deadline_expired = False
+
+        def expire_run_deadline():
+            nonlocal run_deadline_expired
+            run_deadline_expired = True
+            stream_task.cancel()
+
+        run_deadline = asyncio.get_running_loop().call_later(RUN_TIMEOUT_S, expire_run_deadline)
+        try:
+            await stream_task
+        except (TimeoutError, asyncio.TimeoutError) as e:
+            raise RuntimeError(f"Assistant stream failed: {e!r}") from e
+        except asyncio.CancelledError:
+            if not run_deadline_expired:
+                raise
+            if run:
+                logger.warning("Run %s timed out after %s seconds.", run.id, RUN_TIMEOUT_S)
+                await cancel_run_if_active(openai_thread_id, run)
+            raise TimeoutError("Assistant run timed out.")
+        finally:
+            run_deadline.cancel()
+
+        if run is None:
+            raise RuntimeError("Assistant stream ended without reporting a run.")
 
         # --- 5. Process Final Run Status ---
         if run.status == "completed":
-            logger.info(f"Run {run.id} completed.")
-            # --- 6. Retrieve Assistant Messages ---
-            messages_response = openai_client.beta.threads.messages.list(
-                thread_id=openai_thread_id, order="desc"
-            )
-            assistant_messages = [m for m in messages_response.data if m.run_id == run.id and m.role == "assistant"]
-
-            if not assistant_messages:
-                 logger.warning(f"Run {run.id} completed but no new assistant messages found.")
+            logger.info("Run %s completed.", run.id)
+            # --- 6. Collect Assistant Messages ---
+            ai_response = "\n".join(completed_texts).strip()
+            if not ai_response:
+                 logger.warning("Run %s completed but no new assistant messages found.", run.id)
                  ai_response = "I processed your request, but didn't generate a text response."
             else:
-                ai_response = "\n".join(
-                    content_block.text.value
-                    for msg in reversed(assistant_messages)
-                    for content_block in msg.content
-                    if content_block.type == 'text'
-                ).strip()
-                logger.info(f"Retrieved Assistant response(s) for run {run.id}.")
+                logger.info("Retrieved Assistant response(s) for run %s.", run.id)
 
             # --- 7. Post Response to Slack ---
             if thinking_message_ts:
-                app.client.chat_update(channel=channel_id, ts=thinking_message_ts, text=ai_response)
+                await rate_limited_chat_update(channel_id, thinking_message_ts, ai_response)
             else:
-                say(text=ai_response, thread_ts=slack_thread_ts)
+                await rate_limited_say(say, channel_id, ai_response, slack_thread_ts)
 
         elif run.status == "requires_action":
-            logger.warning(f"Run {run.id} requires action - not handled.")
+            logger.warning("Run %s requires action - not handled.", run.id)
+            # The run would otherwise block this OpenAI thread until it expires
+            await cancel_run_if_active(openai_thread_id, run)
             error_message = "Sorry, my current task requires actions I can't perform yet."
-            if thinking_message_ts: app.client.chat_update(channel=channel_id, ts=thinking_message_ts, text=error_message)
-            else: say(text=error_message, thread_ts=slack_thread_ts)
+            if thinking_message_ts: await rate_limited_chat_update(channel_id, thinking_message_ts, error_message)
+            else: await rate_limited_say(say, channel_id, error_message, slack_thread_ts)
 
         else: # failed, cancelled, expired
             error_details = f"Assistant Run {run.id} ended with status: {run.status}"
             if run.last_error:
                 error_details = f"Run failed: {run.last_error.code} - {run.last_error.message}"
-                logger.error(f"Run {run.id} Last Error: {run.last_error.code} - {run.last_error.message}")
+                logger.error("Run %s Last Error: %s - %s", run.id, run.last_error.code, run.last_error.message)
             else:
                  logger.error(error_details)
-            if thinking_message_ts: app.client.chat_update(channel=channel_id, ts=thinking_message_ts, text=error_details)
-            else: say(text=error_details, thread_ts=slack_thread_ts)
+            if thinking_message_ts: await rate_limited_chat_update(channel_id, thinking_message_ts, error_details)
+            else: await rate_limited_say(say, channel_id, error_details, slack_thread_ts)
 
     # --- Error Handling for the entire process ---
     except OpenAIError as e:
-        logger.error(f"OpenAI API Error during Assistant operation: {e}")
+        logger.error("OpenAI API Error during Assistant operation: %s", e)
+        await cancel_run_if_active(openai_thread_id, run)
         error_message = f"Sorry, I encountered an error with the OpenAI API: {e}"
-        if thinking_message_ts: app.client.chat_update(channel=channel_id, ts=thinking_message_ts, text=error_message)
-        else: say(text=error_message, thread_ts=slack_thread_ts)
+        if thinking_message_ts: await rate_limited_chat_update(channel_id, thinking_message_ts, error_message)
+        else: await rate_limited_say(say, channel_id, error_message, slack_thread_ts)
     except TimeoutError as e:
-        logger.error(f"TimeoutError: {e}")
+        logger.error("TimeoutError: %s", e)
         error_message = "Sorry, the request took too long to process."
-        if thinking_message_ts: app.client.chat_update(channel=channel_id, ts=thinking_message_ts, text=error_message)
-        else: say(text=error_message, thread_ts=slack_thread_ts)
+        if thinking_message_ts: await rate_limited_chat_update(channel_id, thinking_message_ts, error_message)
+        else: await rate_limited_say(say, channel_id, error_message, slack_thread_ts)
     except SlackApiError as e:
-         logger.error(f"Slack API Error during processing or response: {e}")
+         logger.error("Slack API Error during processing or response: %s", e)
          # Avoid trying to respond further if Slack API itself failed
     except Exception as e:
         logger.exception(f"An unexpected error occurred in process_with_assistant: {e}")
+        await cancel_run_if_active(openai_thread_id, run)
         error_message = "Sorry, an unexpected error occurred. See logs for details."
         # Try to update/send error message, but be cautious
         try:
-            if thinking_message_ts: app.client.chat_update(channel=channel_id, ts=thinking_message_ts, text=error_message)
-            else: say(text=error_message, thread_ts=slack_thread_ts)
+            if thinking_message_ts: await rate_limited_chat_update(channel_id, thinking_message_ts, error_message)
+            else: await rate_limited_say(say, channel_id, error_message, slack_thread_ts)
         except SlackApiError as slack_e:
-             logger.error(f"Failed to send final error message via Slack: {slack_e}")
+             logger.error("Failed to send final error message via Slack: %s", slack_e)
+
+
+def get_slack_thread_lock(slack_thread_ts):
+    """Returns the lock serializing Assistant runs for a Slack thread."""
+    lock = slack_thread_locks.get(slack_thread_ts)
+    if lock is None:
+        lock = asyncio.Lock()
+        slack_thread_locks[slack_thread_ts] = lock
+    return lock
+
+async def process_with_assistant_serialized(prompt, slack_thread_ts, channel_id, user_id, say, logger, openai_thread_id=None):
+    """Runs process_with_assistant while holding the Slack thread's lock and a run slot."""
+    global pending_task_count
+    try:
+        async with get_slack_thread_lock(slack_thread_ts):
+            async with run_slots:
+                await process_with_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger, openai_thread_id)
+    finally:
+        pending_task_count -= 1
+
+async def submit_to_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger, openai_thread_id=None):
+    """Schedules a prompt for background processing so the event handler returns immediately."""
+    global pending_task_count
+    if pending_task_count >= MAX_PENDING_TASKS:
+        logger.warning("Assistant queue full (%s tasks), rejecting message in Slack thread: %s", MAX_PENDING_TASKS, slack_thread_ts)
+        try:
+            await say(text="Sorry, I'm handling too many requests right now. Please try again in a moment.", thread_ts=slack_thread_ts)
+        except SlackApiError as e:
+            logger.error("Slack error reporting busy status: %s", e)
+        return
+    pending_task_count += 1
+    task = asyncio.create_task(process_with_assistant_serialized(prompt, slack_thread_ts, channel_id, user_id, say, logger, openai_thread_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 
 # --- Slack Event Handlers ---
 
 @app.event("app_mention")
-def handle_mention_assistant(event, say, logger):
+async def handle_mention_assistant(ack, body, context, event, say, logger):
     """Handles direct mentions of the bot."""
+    await ack() # Acknowledge right away; the Assistant work runs as a background task
+    remember_bot_user_id(context.bot_user_id)
     if not BOT_USER_ID:
          logger.error("BOT_USER_ID not available, cannot process mention.")
          # Maybe send a message? Depends on desired behavior.
@@ -212,7 +436,7 @@ def handle_mention_assistant(event, say, logger):
     message_ts = event.get("ts")
 
     # Clean the mention from the prompt specifically for mentions
-    prompt = clean_mention(user_message_raw, BOT_USER_ID)
+    prompt = clean_mention(user_message_raw)
 
     if not prompt:
         logger.info("Received mention without any text content.")
@@ -220,75 +444,96 @@ def handle_mention_assistant(event, say, logger):
         # say("Please provide a message after mentioning me.", thread_ts=slack_thread_ts)
         return
 
-    logger.info(f"Processing mention from {user_id} in channel {channel_id} (Slack thread: {slack_thread_ts}): '{prompt}'")
+    # Slack redelivers events that were not acked in time; only handle each one once.
+    # The same Redis round-trip also fetches the Slack thread's OpenAI thread mapping.
+    is_duplicate, openai_thread_id = await claim_event(body.get("event_id") or event.get("client_msg_id") or message_ts, slack_thread_ts)
+    if is_duplicate:
+        logger.info("Ignoring duplicate delivery of mention %s in channel %s", message_ts, channel_id)
+        return
+
+    logger.info("Processing mention from %s in channel %s (Slack thread: %s): '%s'", user_id, channel_id, slack_thread_ts, prompt)
 
-    # Call the refactored processing function
-    process_with_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger)
+    # Hand off to a background task so the handler returns right away
+    await submit_to_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger, openai_thread_id)
 
 
 @app.event("message")
-def handle_message_events(message, say, logger):
+async def handle_message_events(ack, body, context, message, say, logger):
     """Handles regular messages in channels/DMs the bot is in."""
-    channel_type = message.get("channel_type") # e.g., 'channel', 'im', 'mpim', 'group'
+    await ack() # Acknowledge right away; the Assistant work runs as a background task
+    remember_bot_user_id(context.bot_user_id)
 
-    # --- Filtering ---
+    # --- Filtering (cheapest checks first) ---
     # Ignore messages with subtypes (edits, joins, bot messages, etc.)
     # 'bot_message' subtype specifically filters out messages from other bots AND self
     # Still check for BOT_USER_ID in case of edge cases or manual message posts via API
-    if message.get("subtype") is not None and message.get("subtype") != "thread_broadcast":
+    subtype = message.get("subtype")
+    if subtype is not None and subtype != "thread_broadcast":
         # Allow thread_broadcast subtype, ignore others
-        # logger.debug(f"Ignoring message with subtype: {message.get('subtype')}")
+        # logger.debug("Ignoring message with subtype: %s", subtype)
         return
 
     # Ignore messages from the bot itself (double check)
-    if message.get("user") == BOT_USER_ID or message.get("bot_id"):
-         # logger.debug("Ignoring message from self or a bot.")
+    if message.get("bot_id"):
+         # logger.debug("Ignoring message from a bot.")
+         return
+    user_id = message.get("user") # Should be present if not a subtype message
+    if user_id == BOT_USER_ID:
+         # logger.debug("Ignoring message from self.")
          return
-
-    # Ignore mentions, handled by app_mention (check specifically for start of message)
-    if message.get("text", "").strip().startswith(f"<@{BOT_USER_ID}>"):
-        # logger.debug("Ignoring mention, handled by app_mention handler.")
-        return
 
     # --- Decide WHERE to respond ---
     # Respond in DMs ('im')
     # Respond in channels/groups ('channel', 'group') *only if bot was invited*
     # Potentially respond in MPIMs ('mpim') - group DMs
-    # >>> Adjust this logic based on desired behavior <<<
-    if channel_type not in ["channel", "group", "im", "mpim"]:
-         logger.debug(f"Ignoring message in unsupported channel type: {channel_type}")
+    # >>> Adjust SUPPORTED_CHANNEL_TYPES based on desired behavior <<<
+    channel_type = message.get("channel_type") # e.g., 'channel', 'im', 'mpim', 'group'
+    if channel_type not in SUPPORTED_CHANNEL_TYPES:
+         logger.debug("Ignoring message in unsupported channel type: %s", channel_type)
          return
 
-    # --- Extract Info ---
+    # Ignore mentions, handled by app_mention (check specifically for start of message)
     prompt = message.get("text", "")
+    if BOT_MENTION_PREFIX and prompt.lstrip().startswith(BOT_MENTION_PREFIX):
+        # logger.debug("Ignoring mention, handled by app_mention handler.")
+        return
+
+    # --- Extract Info ---
     channel_id = message.get("channel")
-    user_id = message.get("user") # Should be present if not a subtype message
     slack_thread_ts = message.get("thread_ts", message.get("ts"))
 
     # Basic validation
     if not prompt or not user_id:
-         logger.warning(f"Message event missing prompt or user_id after filtering. Subtype: {message.get('subtype')}, User: {message.get('user')}, BotID: {message.get('bot_id')}")
+         logger.warning("Message event missing prompt or user_id after filtering. Subtype: %s, User: %s", subtype, user_id)
          return
 
+    # Slack redelivers events that were not acked in time; only handle each one once.
+    # The same Redis round-trip also fetches the Slack thread's OpenAI thread mapping.
+    is_duplicate, openai_thread_id = await claim_event(body.get("event_id") or message.get("client_msg_id") or message.get("ts"), slack_thread_ts)
+    if is_duplicate:
+        logger.info("Ignoring duplicate delivery of message %s in channel %s", message.get('ts'), channel_id)
+        return
+
     # --- Process ---
-    logger.info(f"Processing general message from {user_id} in {channel_type} {channel_id} (Slack thread: {slack_thread_ts}): '{prompt}'")
+    logger.info("Processing general message from %s in %s %s (Slack thread: %s): '%s'", user_id, channel_type, channel_id, slack_thread_ts, prompt)
 
-    # Call the refactored processing function
-    process_with_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger)
+    # Hand off to a background task so the handler returns right away
+    await submit_to_assistant(prompt, slack_thread_ts, channel_id, user_id, say, logger, openai_thread_id)
 
-def run():
+async def main():
     required_vars = ["SLACK_BOT_TOKEN", "SLACK_APP_TOKEN", "OPENAI_API_KEY", "OPENAI_ASSISTANT_ID"]
     if not all(os.environ.get(var) for var in required_vars):
         missing = [var for var in required_vars if not os.environ.get(var)]
-        logging.error(f"Missing required environment variables: {', '.join(missing)}")
-    elif not BOT_USER_ID:
-         logging.error("Failed to get bot user ID. Bot cannot start.")
-    else:
-        logger.info(f"Bot User ID: {BOT_USER_ID}")
-        logger.info(f"Using Assistant ID: {OPENAI_ASSISTANT_ID}")
-        logger.info("Starting bot in Socket Mode...")
-        handler = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
-        handler.start()
+        logging.error("Missing required environment variables: %s", ', '.join(missing))
+        return
+
+    logger.info("Using Assistant ID: %s", OPENAI_ASSISTANT_ID)
+    logger.info("Starting bot in Socket Mode...")
+    handler = AsyncSocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
+    await handler.start_async()
+
+def run():
+    asyncio.run(main())
 
 # --- Start the Bot ---
 if __name__ == "__main__":